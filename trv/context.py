@@ -1,84 +1,154 @@
 import os
+
+# Включаем параллелизм Rust-токенизатора до импорта transformers,
+# иначе переменная окружения не подействует
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
 import argparse
 import fnmatch
+import queue
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import duckdb
 from transformers import GemmaTokenizerFast
 import traceback
-from typing import List, Tuple, Dict
-from tqdm import tqdm
+from typing import Iterator, List, Optional, Tuple, Dict
 
 # --- Вспомогательные функции ---
 
-# Инициализация токенизатора Gemma
-_tokenizer = GemmaTokenizerFast.from_pretrained("google/gemma-3-27b-it")
-
+# Токенизатор Gemma загружается лениво: каждый процесс платит за загрузку
+# только если действительно дошел до подсчета токенов
+_tokenizer = None
 
-def estimate_gemini_tokens(text: str, batch_size: int = 500_000) -> int:
+def get_tokenizer():
     """
-    Оценивает количество токенов для Gemini, используя токенизатор Gemma, если он доступен,
-    иначе использует простое правило: 1 токен ~ 4 символа.
-    Обрабатывает текст по батчам для эффективности.
+    Возвращает закешированный на уровне модуля токенизатор Gemma,
+    загружая его при первом обращении.
     """
-    if not text: return 0
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = GemmaTokenizerFast.from_pretrained("google/gemma-3-27b-it")
+    return _tokenizer
 
-    if _tokenizer:
-        # Разбиваем текст на батчи и подсчитываем токены постепенно
-        total_tokens = 0
-        # Разбиваем на батчи по batch_size символов
-        batches = [text[i:i + batch_size] for i in range(0, len(text), batch_size)]
 
-        with tqdm(total=len(batches), desc="Подсчет токенов", unit="батч", disable=len(batches) < 2) as pbar:
-            for batch in batches:
-                if batch:  # Проверяем, что батч не пустой
-                    total_tokens += len(_tokenizer.encode(batch))
-                pbar.update(1)
-
-        return total_tokens
+def _split_long_text(text: str, max_chars: int = 500_000) -> List[str]:
+    """
+    Режет очень длинный текст на куски по границам строк, чтобы Rayon
+    мог распараллелить кодирование внутри одного батча.
+    """
+    if len(text) <= max_chars:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + max_chars
+        if end < len(text):
+            # Сдвигаем границу к ближайшему переводу строки, чтобы не резать токен
+            newline = text.rfind('\n', start, end)
+            if newline > start:
+                end = newline + 1
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+def estimate_gemini_tokens(texts: List[str], exact: bool = True) -> int:
+    """
+    Оценивает количество токенов для Gemini по списку текстовых блоков.
+    При exact=True используется токенизатор Gemma (батчевое кодирование
+    на стороне Rust), при exact=False — быстрое правило 1 токен ~ 4 символа:
+    для прикидочного отчета этого достаточно, а токенизатор даже не загружается.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    texts = [t for t in texts if t]
+    if not texts: return 0
+
+    if not exact:
+        return sum(len(t) for t in texts) // 4
+
+    tokenizer = get_tokenizer()
+    if tokenizer:
+        # Один огромный блок не распараллелится — дробим его заранее
+        batch = [chunk for t in texts for chunk in _split_long_text(t)]
+        # Идем напрямую в Rust-токенизатор: encode_batch пропускает
+        # постобработку (attention mask и т.п.), нам нужен только счет
+        encodings = tokenizer.backend_tokenizer.encode_batch(batch, add_special_tokens=False)
+        return sum(len(e.ids) for e in encodings)
     else:
         # Fallback к простому правилу, если токенизатор Gemma недоступен
-        return len(text) // 4
+        return sum(len(t) for t in texts) // 4
+
+# Расширения, для которых файл заведомо текстовый — проверка на бинарность не нужна
+TEXT_EXTS = {".sql", ".md", ".txt", ".json", ".yml", ".yaml", ".csv", ".py", ".ipynb"}
 
 def is_binary(filepath: str) -> bool:
     """
     Проверяет, является ли файл бинарным, ища нулевой байт в начале файла.
+    Для известных текстовых расширений файл даже не открывается.
     """
+    if os.path.splitext(filepath)[1].lower() in TEXT_EXTS:
+        return False
     try:
         with open(filepath, 'rb') as f:
-            return b'\x00' in f.read(1024)
+            return f.read(1024).find(b'\x00') >= 0
     except IOError:
         return True
 
-def is_excluded(path: str, exclude_patterns: List[str]) -> bool:
+def compile_exclude_patterns(exclude_patterns: List[str]) -> Optional[re.Pattern]:
     """
-    Проверяет, соответствует ли путь (файл или папка) одному из шаблонов исключения.
+    Компилирует список glob-шаблонов в один регекс-альтернативу.
+    Возвращает None, если список пуст.
     """
-    path_basename = os.path.basename(path)
-    for pattern in exclude_patterns:
-        if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path_basename, pattern):
-            return True
-    return False
+    if not exclude_patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in exclude_patterns))
+
+def is_excluded(path: str, exclude_re) -> bool:
+    """
+    Проверяет, соответствует ли путь (файл или папка) скомпилированному
+    регексу исключений (см. compile_exclude_patterns).
+    """
+    if exclude_re is None:
+        return False
+    return bool(exclude_re.match(path) or exclude_re.match(os.path.basename(path)))
 
 # --- Функции для работы с файловой системой ---
 
-def generate_file_tree(start_path: str, exclude_patterns: List[str], prefix: str = "") -> List[str]:
+def generate_file_tree(start_path: str, exclude_re) -> List[str]:
     """
-    Рекурсивно генерирует строки с деревом файлов, учитывая исключения.
+    Генерирует строки с деревом файлов, учитывая исключения.
+    Обход итеративный, с явным стеком — без рекурсии и промежуточных списков
+    на каждую директорию.
     """
     tree_lines = []
-    try:
-        entries = sorted([e for e in os.listdir(start_path) if not is_excluded(os.path.join(start_path, e), exclude_patterns)])
-    except FileNotFoundError:
-        return []
+    # Стек элементов (DirEntry, префикс, является ли последним в своей директории)
+    stack = []
+
+    def push_dir(path, prefix):
+        try:
+            # os.scandir отдает DirEntry с закешированным типом — без лишних stat
+            entries = sorted(
+                (e for e in os.scandir(path) if not is_excluded(e.path, exclude_re)),
+                key=lambda e: e.name
+            )
+        except FileNotFoundError:
+            return
+        # Кладем в обратном порядке, чтобы порядок выдачи совпадал с обходом
+        last = len(entries) - 1
+        for i in range(last, -1, -1):
+            stack.append((entries[i], prefix, i == last))
+
+    push_dir(start_path, "")
+    while stack:
+        entry, prefix, is_last = stack.pop()
+        connector = "└── " if is_last else "├── "
+        tree_lines.append(f"{prefix}{connector}{entry.name}")
+
+        if entry.is_dir(follow_symlinks=False):
+            push_dir(entry.path, prefix + ("    " if is_last else "│   "))
 
-    for i, entry in enumerate(entries):
-        connector = "├── " if i < len(entries) - 1 else "└── "
-        tree_lines.append(f"{prefix}{connector}{entry}")
-        
-        full_path = os.path.join(start_path, entry)
-        if os.path.isdir(full_path):
-            extension = "│   " if i < len(entries) - 1 else "    "
-            tree_lines.extend(generate_file_tree(full_path, exclude_patterns, prefix + extension))
-            
     return tree_lines
 
 # --- Функции для работы с DuckDB ---
@@ -87,103 +157,149 @@ def get_db_tables(cursor) -> List[str]:
     cursor.execute("SHOW TABLES;")
     return [table[0] for table in cursor.fetchall()]
 
-def get_db_columns_info(cursor, table_name: str) -> Tuple[List[str], str]:
+def get_db_table_meta(cursor, table_name: str) -> Tuple[List[str], str, str, int]:
+    """
+    Возвращает (имена колонок, строку с описанием колонок, имя PK, индекс PK)
+    за один вызов PRAGMA table_info.
+    """
     cursor.execute(f'PRAGMA table_info("{table_name}");')
     columns = cursor.fetchall()
     names = [col[1] for col in columns]
     info_str = ", ".join([f"{col[1]} ({col[2]})" for col in columns])
-    return names, info_str
-
-def get_db_primary_key_info(cursor, table_name: str) -> Tuple[str, int]:
-    cursor.execute(f'PRAGMA table_info("{table_name}");')
-    columns_info = cursor.fetchall()
-    for col in columns_info:
+    pk_name, pk_index = "ID", 0
+    for col in columns:
         if col[5]:
-            return col[1], col[0]
-    return "ID", 0
+            pk_name, pk_index = col[1], col[0]
+            break
+    return names, info_str, pk_name, pk_index
 
-def format_value(value):
+def _format_struct(value) -> str:
+    # STRUCT - вложенный объект
+    try:
+        # Пытаемся преобразовать в читаемый формат
+        items = []
+        for key, val in value.items():
+            items.append(f"{key}: {format_value(val)}")
+        return "{" + ", ".join(items) + "}"
+    except:
+        return str(value)
+
+def _format_list_or_map(value) -> str:
+    # LIST/MAP - массивы и словари
+    try:
+        if hasattr(value, 'values'):
+            # Map
+            items = []
+            for k, v in value.items():
+                items.append(f"{k}=>{format_value(v)}")
+            return "{" + ", ".join(items) + "}"
+        else:
+            # List
+            items = [format_value(item) for item in value]
+            return "[" + ", ".join(items) + "]"
+    except:
+        return str(value)
+
+# Кеш диспетчеризации: конкретный тип значения -> функция форматирования.
+# Заполняется лениво, чтобы не перечислять заранее все типы DuckDB.
+_FORMAT_DISPATCH: Dict[type, object] = {}
+
+def format_value(value) -> str:
     """
     Форматирует значение для читаемого вывода, включая nested структуры.
+    Вместо сравнения имени класса на каждой ячейке — один поиск по словарю типов.
     """
     if value is None:
         return ""
 
-    # Обрабатываем типы DuckDB
-    if hasattr(value, '__class__'):
-        class_name = value.__class__.__name__
-
-        # STRUCT - вложенный объект
+    value_type = type(value)
+    formatter = _FORMAT_DISPATCH.get(value_type)
+    if formatter is None:
+        # Обрабатываем типы DuckDB; простые скаляры и все прочее — через str
+        class_name = value_type.__name__
         if class_name == 'Struct':
-            try:
-                # Пытаемся преобразовать в читаемый формат
-                items = []
-                for key, val in value.items():
-                    formatted_val = format_value(val)
-                    items.append(f"{key}: {formatted_val}")
-                return "{" + ", ".join(items) + "}"
-            except:
-                return str(value)
-
-        # LIST/MAP - массивы и словари
-        elif class_name in ['List', 'Map']:
-            try:
-                if hasattr(value, 'values'):
-                    # Map
-                    items = []
-                    for k, v in value.items():
-                        formatted_val = format_value(v)
-                        items.append(f"{k}=>{formatted_val}")
-                    return "{" + ", ".join(items) + "}"
-                else:
-                    # List
-                    items = [format_value(item) for item in value]
-                    return "[" + ", ".join(items) + "]"
-            except:
-                return str(value)
-
-        # Другие типы - пробуем строку
+            formatter = _format_struct
+        elif class_name in ('List', 'Map'):
+            formatter = _format_list_or_map
         else:
-            return str(value)
-    else:
-        # Простые типы
-        return str(value)
+            formatter = str
+        _FORMAT_DISPATCH[value_type] = formatter
+    return formatter(value)
 
-def format_db_row(row: tuple, column_names: List[str], pk_name: str, pk_index: int) -> str:
-    if not row or not column_names: return ""
-    pk_value = format_value(row[pk_index] if row and len(row) > pk_index else "N/A")
-    pk_tag = pk_name.upper()
+def format_db_row(row: tuple, upper_names: List[str], non_pk_indices: List[int], pk_tag: str, pk_index: int) -> str:
+    """
+    Форматирует одну строку таблицы. Имена колонок в верхнем регистре и
+    индексы неключевых колонок вычисляются один раз на таблицу и передаются
+    готовыми — в цикле по миллионам строк ни upper(), ни проверок индекса.
+    """
+    if not row or not upper_names: return ""
+    pk_value = format_value(row[pk_index] if len(row) > pk_index else "N/A")
     start_part = f"{pk_tag}: {pk_value}"
     end_part = f"END {pk_tag}: {pk_value}"
-    content_parts = [f"{col_name.upper()}: {format_value(row[i]) if row[i] is not None else ''}" for i, col_name in enumerate(column_names) if i != pk_index]
+    content_parts = [f"{upper_names[i]}: {format_value(row[i]) if row[i] is not None else ''}" for i in non_pk_indices]
     return " | ".join([start_part] + content_parts + [end_part])
 
+def walk_files(start_path: str, exclude_re) -> Iterator[os.DirEntry]:
+    """
+    Рекурсивно обходит дерево через os.scandir и отдает DirEntry файлов.
+    Исключенные файлы отфильтровываются, в исключенные директории обход не заходит.
+    """
+    try:
+        entries = sorted(os.scandir(start_path), key=lambda e: e.name)
+    except OSError:
+        # Недоступные директории пропускаем молча, как это делал os.walk
+        return
+
+    subdirs = []
+    for entry in entries:
+        if is_excluded(entry.path, exclude_re):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        else:
+            yield entry
+
+    for subdir in subdirs:
+        yield from walk_files(subdir, exclude_re)
+
 # --- Основная логика сбора контента ---
 
-def process_database_file(db_path: str, exclude_table_patterns: List[str]) -> str:
+def process_database_file(db_path: str, exclude_table_re) -> str:
     """
     Обрабатывает один файл базы данных DuckDB и возвращает его содержимое в виде строки.
     """
     relative_path = os.path.relpath(db_path)
     db_content = [f"[DATABASE {relative_path}]"]
     try:
-        conn = duckdb.connect(db_path, read_only=True)
+        # Даем DuckDB все ядра на скан и ограничиваем его аппетит по памяти
+        conn = duckdb.connect(db_path, read_only=True, config={
+            "threads": str(os.cpu_count()),
+            "memory_limit": "2GB",
+        })
         cursor = conn.cursor()
         tables = get_db_tables(cursor)
         if not tables:
             db_content.append(f"INFO: В базе данных таблицы не найдены.")
         
         for table_name in tables:
-            if is_excluded(table_name, exclude_table_patterns): continue
+            if is_excluded(table_name, exclude_table_re): continue
             db_content.append(f"[TABLE {table_name}]")
-            column_names, columns_str = get_db_columns_info(cursor, table_name)
+            column_names, columns_str, pk_name, pk_index = get_db_table_meta(cursor, table_name)
             db_content.append(f"COLUMNS: {columns_str}")
-            pk_name, pk_index = get_db_primary_key_info(cursor, table_name)
-            
+
+            # Инварианты таблицы считаем один раз, вне цикла по строкам
+            upper_names = [name.upper() for name in column_names]
+            non_pk_indices = [i for i in range(len(column_names)) if i != pk_index]
+            pk_tag = pk_name.upper()
+
             cursor.execute(f'SELECT * FROM "{table_name}";')
-            rows = cursor.fetchall()
-            for row in rows:
-                db_content.append(format_db_row(row, column_names, pk_name, pk_index))
+            # Стримим строки батчами, не материализуя всю таблицу в память
+            while True:
+                rows = cursor.fetchmany(100_000)
+                if not rows:
+                    break
+                for row in rows:
+                    db_content.append(format_db_row(row, upper_names, non_pk_indices, pk_tag, pk_index))
             db_content.append(f"[END TABLE {table_name}]")
         conn.close()
     except duckdb.Error as e:
@@ -192,7 +308,97 @@ def process_database_file(db_path: str, exclude_table_patterns: List[str]) -> st
     db_content.append(f"[END DATABASE {relative_path}]\n")
     return "\n".join(db_content)
 
-def collect_and_separate_contents(start_path: str, exclude_patterns: List[str], exclude_table_patterns: List[str]) -> Tuple[Dict[str, List[str]], List[str]]:
+# Сколько чтений файлов держим в полете одновременно
+_PREFETCH_WORKERS = 8
+_PREFETCH_WINDOW = 64
+
+def _read_file_bytes(file_path: str) -> Tuple[Optional[bytes], Optional[Exception]]:
+    """Читает файл целиком; ошибку возвращает вторым элементом кортежа."""
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read(), None
+    except Exception as e:
+        return None, e
+
+def _build_block(entry, future, start_path: str, exclude_table_re):
+    """
+    Собирает готовый блок из записи обхода и (для текста) результата
+    предвыборки байтов. Вместо future может прийти int — размер файла,
+    отвергнутого по порогу: для него создается блок-заглушка без чтения.
+    Возвращает None для бинарных файлов.
+    """
+    file_path = entry.path
+    relative_path = os.path.relpath(file_path, start_path)
+
+    if future is None:
+        return "db", None, process_database_file(file_path, exclude_table_re)
+
+    # Определяем тип файла по расширению
+    _, ext = os.path.splitext(entry.name)
+    file_type = ext[1:] if ext else "no_extension"  # Убираем точку из расширения
+
+    if isinstance(future, int):
+        size = future
+        stub = (f"[{relative_path}]\n"
+                f"Файл пропущен по размеру: {size} байт (~{size // 4} токенов)\n"
+                f"[END {relative_path}]\n")
+        return "text", file_type, stub
+
+    content_block = [f"[{relative_path}]"]
+    data, error = future.result()
+    if error is not None:
+        content_block.append(f"Не удалось прочитать файл: {error}")
+    else:
+        # Проверка на бинарность и декодирование работают с одним буфером
+        if ext.lower() not in TEXT_EXTS and data[:1024].find(b'\x00') >= 0:
+            return None
+        content_block.append(data.decode('utf-8', errors='ignore'))
+
+    content_block.append(f"[END {relative_path}]\n")
+    return "text", file_type, "\n".join(content_block)
+
+def iter_contents(start_path: str, exclude_re, exclude_table_re,
+                  max_text_bytes: int = 0) -> Iterator[Tuple[str, Optional[str], str]]:
+    """
+    Публичный генератор готовых блоков содержимого: отдает кортежи
+    ("db", None, блок) для баз данных и ("text", тип файла, блок) для текста.
+    Байты файлов читаются с опережением пулом потоков (скользящее окно),
+    чтобы диск не простаивал; порядок обхода при этом сохраняется.
+    Файлы крупнее max_text_bytes (0 — без ограничения) не читаются вовсе:
+    вместо содержимого идет заглушка с оценкой размера.
+    """
+    with ThreadPoolExecutor(max_workers=_PREFETCH_WORKERS) as pool:
+        pending = deque()
+        for entry in walk_files(start_path, exclude_re):
+            if entry.name.endswith((".db", ".duckdb")):
+                # Базы обрабатываем при выдаче, в порядке обхода
+                pending.append((entry, None))
+            elif max_text_bytes:
+                # На Linux stat() у DirEntry — это отдельный syscall; делаем его
+                # только когда задан порог, и не роняем обход из-за одного файла
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                if size > max_text_bytes:
+                    pending.append((entry, size))
+                else:
+                    pending.append((entry, pool.submit(_read_file_bytes, entry.path)))
+            else:
+                pending.append((entry, pool.submit(_read_file_bytes, entry.path)))
+
+            if len(pending) >= _PREFETCH_WINDOW:
+                block = _build_block(*pending.popleft(), start_path, exclude_table_re)
+                if block is not None:
+                    yield block
+
+        while pending:
+            block = _build_block(*pending.popleft(), start_path, exclude_table_re)
+            if block is not None:
+                yield block
+
+def collect_and_separate_contents(start_path: str, exclude_re, exclude_table_re,
+                                  max_text_bytes: int = 0) -> Tuple[Dict[str, List[str]], List[str]]:
     """
     Рекурсивно обходит директорию, собирая содержимое текстовых файлов
     и баз данных. Бизнес-контекст группируются по типам (расширениям).
@@ -200,41 +406,120 @@ def collect_and_separate_contents(start_path: str, exclude_patterns: List[str],
     text_contents_by_type = {}
     db_contents = []
 
-    for root, dirs, files in os.walk(start_path, topdown=True):
-        dirs[:] = [d for d in dirs if not is_excluded(os.path.join(root, d), exclude_patterns)]
+    for kind, file_type, block in iter_contents(start_path, exclude_re, exclude_table_re, max_text_bytes):
+        if kind == "db":
+            db_contents.append(block)
+        else:
+            text_contents_by_type.setdefault(file_type, []).append(block)
 
-        for filename in sorted(files):
-            file_path = os.path.join(root, filename)
-            if is_excluded(file_path, exclude_patterns): continue
+    return text_contents_by_type, db_contents
 
-            relative_path = os.path.relpath(file_path, start_path)
+_QUEUE_END = object()
 
-            if filename.endswith((".db", ".duckdb")):
-                db_contents.append(process_database_file(file_path, exclude_table_patterns))
-                continue
+def collect_and_count_contents(start_path: str, exclude_re, exclude_table_re,
+                               batch_size: int = 64, exact: bool = True,
+                               max_text_bytes: int = 0) -> Tuple[Dict[str, List[str]], List[str], Dict[str, int], int]:
+    """
+    Совмещает дисковый ввод-вывод с токенизацией: фоновый поток обходит
+    дерево и читает файлы, а основной поток параллельно считает токены
+    накопленными батчами (fast-токенизатор отпускает GIL на стороне Rust).
+    Возвращает (text_contents_by_type, db_contents, tokens_by_type, tokens_db).
+    """
+    block_queue = queue.Queue(maxsize=64)
+    producer_error: List[BaseException] = []
+
+    def producer():
+        try:
+            for item in iter_contents(start_path, exclude_re, exclude_table_re, max_text_bytes):
+                block_queue.put(item)
+        except BaseException as e:
+            # Запоминаем ошибку фонового потока — поднимем её в основном,
+            # иначе обход молча оборвётся и результат будет неполным
+            producer_error.append(e)
+        finally:
+            block_queue.put(_QUEUE_END)
+
+    reader = threading.Thread(target=producer, daemon=True)
+    reader.start()
 
-            if is_binary(file_path): continue
+    text_contents_by_type = {}
+    db_contents = []
+    tokens_by_type = {}
+    tokens_db = 0
+    # Блоки, накопленные для следующего батча токенизации, по типам
+    pending_text = {}
+    pending_db = []
+
+    while True:
+        item = block_queue.get()
+        if item is _QUEUE_END:
+            break
+        kind, file_type, block = item
+
+        if kind == "db":
+            db_contents.append(block)
+            pending_db.append(block)
+            if len(pending_db) >= batch_size:
+                tokens_db += estimate_gemini_tokens(pending_db, exact=exact)
+                pending_db = []
+            continue
+
+        text_contents_by_type.setdefault(file_type, []).append(block)
+        batch = pending_text.setdefault(file_type, [])
+        batch.append(block)
+        if len(batch) >= batch_size:
+            tokens_by_type[file_type] = tokens_by_type.get(file_type, 0) + estimate_gemini_tokens(batch, exact=exact)
+            pending_text[file_type] = []
+
+    reader.join()
+    if producer_error:
+        raise producer_error[0]
+
+    # Добиваем неполные батчи
+    for file_type, batch in pending_text.items():
+        if batch:
+            tokens_by_type[file_type] = tokens_by_type.get(file_type, 0) + estimate_gemini_tokens(batch, exact=exact)
+    if pending_db:
+        tokens_db += estimate_gemini_tokens(pending_db, exact=exact)
+
+    return text_contents_by_type, db_contents, tokens_by_type, tokens_db
+
+def write_blocks(f, blocks: List[str]):
+    """
+    Пишет блоки в открытый файл через разделитель "\\n",
+    не склеивая их в одну гигантскую строку.
+    """
+    for i, block in enumerate(blocks):
+        if i:
+            f.write("\n")
+        f.write(block)
 
-            # Определяем тип файла по расширению
-            _, ext = os.path.splitext(filename)
-            file_type = ext[1:] if ext else "no_extension"  # Убираем точку из расширения
+def compute_token_report(root_dir: str, exclude_patterns: List[str], exclude_table_patterns: List[str],
+                         exact: bool = False, max_text_bytes: int = 0) -> Tuple[int, int, int, Dict[str, int]]:
+    """
+    Считает статистику токенов по папке без запуска CLI и разбора stdout.
+    Возвращает (total, business_context, db, {тип файла: токены}).
+    """
+    exclude_re = compile_exclude_patterns(exclude_patterns)
+    exclude_table_re = compile_exclude_patterns(exclude_table_patterns)
 
-            content_block = [f"[{relative_path}]"]
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content_block.append(f.read())
-            except Exception as e:
-                content_block.append(f"Не удалось прочитать файл: {e}")
+    _, _, tokens_by_type, tokens_db = collect_and_count_contents(
+        root_dir, exclude_re, exclude_table_re, exact=exact, max_text_bytes=max_text_bytes
+    )
 
-            content_block.append(f"[END {relative_path}]\n")
-            content_str = "\n".join(content_block)
+    tree_block = "[FILE TREE]\n" + "\n".join(generate_file_tree(root_dir, exclude_re)) + "\n[END FILE TREE]\n\n"
+    tokens_tree = estimate_gemini_tokens([tree_block], exact=exact)
 
-            # Добавляем в соответствующий тип
-            if file_type not in text_contents_by_type:
-                text_contents_by_type[file_type] = []
-            text_contents_by_type[file_type].append(content_str)
+    # Ключи приводим к тому же виду, что в Markdown-отчете CLI (".sql",
+    # "(без расширения)"), чтобы результат не зависел от способа запуска
+    tokens_by_type = {
+        (f".{file_type}" if file_type != "no_extension" else "(без расширения)"): count
+        for file_type, count in tokens_by_type.items()
+    }
 
-    return text_contents_by_type, db_contents
+    business_tokens = sum(tokens_by_type.values())
+    total_tokens = tokens_tree + business_tokens + tokens_db
+    return total_tokens, business_tokens, tokens_db, tokens_by_type
 
 # --- Точка входа ---
 
@@ -248,6 +533,8 @@ def main():
     parser.add_argument('--output_file', '-o', default='context.txt', help="Имя итогового файла (по умолчанию: context.txt).")
     parser.add_argument('-e', '--exclude', action='append', default=[], help="Шаблон для исключения файлов или папок.")
     parser.add_argument('-et', '--exclude-table', action='append', default=[], dest='exclude_table_patterns', help="Шаблон для исключения таблиц из баз данных.")
+    parser.add_argument('--exact-tokens', action='store_true', dest='exact_tokens', help="Считать токены настоящим токенизатором Gemma вместо быстрой оценки (1 токен ~ 4 символа).")
+    parser.add_argument('--max-text-bytes', type=int, default=0, dest='max_text_bytes', help="Не читать текстовые файлы крупнее указанного размера в байтах (0 — без ограничения).")
     
     args = parser.parse_args()
     
@@ -260,47 +547,33 @@ def main():
     print(f"Сканирование директории: {os.path.abspath(args.root_dir)}")
     print(f"Исключаемые шаблоны файлов/папок: {args.exclude}")
     print(f"Исключаемые шаблоны таблиц БД: {args.exclude_table_patterns}")
-    
+
+    # Компилируем шаблоны исключений один раз на весь запуск
+    exclude_re = compile_exclude_patterns(args.exclude)
+    exclude_table_re = compile_exclude_patterns(args.exclude_table_patterns)
+
     # 1. Генерация дерева файлов
     print("1. Генерация дерева файлов...")
     tree_header = "[FILE TREE]"
     tree_footer = "[END FILE TREE]"
-    file_tree_str = "\n".join(generate_file_tree(args.root_dir, args.exclude))
-    
-    # 2. Сбор содержимого, разделяя текст и БД
-    print("2. Сбор содержимого файлов и данных из БД...")
-    text_contents_by_type, db_contents = collect_and_separate_contents(
-        args.root_dir, args.exclude, args.exclude_table_patterns
+    file_tree_str = "\n".join(generate_file_tree(args.root_dir, exclude_re))
+
+    # 2-3. Сбор содержимого и подсчет токенов идут конвейером:
+    # чтение с диска в фоновом потоке, токенизация батчей — в основном
+    print("2. Сбор содержимого файлов и данных из БД (с подсчетом токенов)...")
+    text_contents_by_type, db_contents, tokens_by_type, tokens_db = collect_and_count_contents(
+        args.root_dir, exclude_re, exclude_table_re,
+        exact=args.exact_tokens, max_text_bytes=args.max_text_bytes
     )
 
-    # <-- НОВОЕ: Подсчет токенов -->
-    print("3. Подсчет токенов...")
-
-    # Собираем все части в строки для подсчета и записи
+    # Блок с деревом файлов — единственное, что склеиваем в строку (он маленький)
     full_tree_block = f"{tree_header}\n{file_tree_str}\n{tree_footer}\n\n"
-    full_text_block = ""
-    for file_type, contents in text_contents_by_type.items():
-        full_text_block += "\n".join(contents)
-    full_db_block = "\n".join(db_contents)
 
     # Считаем токены для дерева файлов
-    print("Подсчет токенов для дерева файлов...")
-    tokens_tree = estimate_gemini_tokens(full_tree_block)
-
-    # Считаем токены по типам файлов
-    tokens_by_type = {}
-    total_text_tokens = 0
-    for file_type, contents in text_contents_by_type.items():
-        type_block = "\n".join(contents)
-        print(f"Подсчет токенов для файлов типа '{file_type}'...")
-        tokens = estimate_gemini_tokens(type_block)
-        tokens_by_type[file_type] = tokens
-        total_text_tokens += tokens
-
-    # Считаем токены для баз данных
-    print("Подсчет токенов для баз данных...")
-    tokens_db = estimate_gemini_tokens(full_db_block)
+    print("3. Подсчет токенов для дерева файлов...")
+    tokens_tree = estimate_gemini_tokens([full_tree_block], exact=args.exact_tokens)
 
+    total_text_tokens = sum(tokens_by_type.values())
     total_tokens = tokens_tree + total_text_tokens + tokens_db
 
     # Создаем детальный отчет о токенах в формате Markdown таблицы
@@ -349,10 +622,9 @@ def main():
     try:
         with open(args.output_file, 'w', encoding='utf-8') as f:
             f.write(full_tree_block)
-            if full_text_block:
-                f.write(full_text_block)
-            if full_db_block:
-                f.write(full_db_block)
+            for contents in text_contents_by_type.values():
+                write_blocks(f, contents)
+            write_blocks(f, db_contents)
 
         print("Готово! Файл успешно создан.")
     except IOError as e:
@@ -1,25 +1,37 @@
 import os
 import re
+import argparse
+import operator
 import fnmatch
+import json
 import subprocess
 import csv
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import List, Tuple, Dict
 
 from tqdm import tqdm
 
 # Add imports from trv.context
-from context import estimate_gemini_tokens
+from context import compute_token_report, estimate_gemini_tokens, compile_exclude_patterns, walk_files, is_binary
 
-def run_context_py_and_parse_results(folder_path: str, exclude_patterns: List[str], exclude_table_patterns: List[str]) -> Tuple[int, int, int, Dict[str, int]]:
+def run_context_py_and_parse_results(folder_path: str, exclude_patterns: List[str], exclude_table_patterns: List[str],
+                                     exact: bool = False) -> Tuple[int, int, int, Dict[str, int]]:
     """
-    Запускает context.py для указанной папки и парсит результаты из context.txt.
+    Запускает context.py для указанной папки и парсит результаты из его вывода.
     Возвращает: (total_tokens, business_context_tokens, db_tokens, file_type_tokens)
     """
+    # Каждому запуску — свой выходной файл, иначе параллельные процессы
+    # затирают общий context.txt
+    with tempfile.NamedTemporaryFile(prefix="context_", suffix=".txt", delete=False) as tmp:
+        output_file = tmp.name
+
     # Подготавливаем аргументы для context.py
     cmd = [
         "python", "trv/context.py",
         folder_path,
-        "--output_file", "context.txt"
+        "--output_file", output_file
     ]
 
     # Добавляем шаблоны исключений
@@ -27,67 +39,214 @@ def run_context_py_and_parse_results(folder_path: str, exclude_patterns: List[st
         cmd.extend(["-e", pattern])
     for pattern in exclude_table_patterns:
         cmd.extend(["-et", pattern])
+    if exact:
+        cmd.append("--exact-tokens")
 
     try:
-        # Запускаем context.py
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.getcwd())
-        if result.returncode != 0:
-            print(f"Ошибка при запуске context.py для {folder_path}: {result.stderr}")
+        # Запускаем context.py и парсим stdout на лету, не буферизуя его целиком
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              text=True, cwd=os.getcwd(), bufsize=1 << 16) as proc:
+            # stderr вычитываем в фоновом потоке: если читать его после stdout,
+            # дочерний процесс может навсегда встать на записи в полный пайп
+            stderr_chunks = []
+            stderr_reader = threading.Thread(
+                target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True
+            )
+            stderr_reader.start()
+            parsed = parse_context_output(proc.stdout)
+            # Дочитываем хвост, чтобы процесс не заблокировался на полном пайпе
+            for _ in proc.stdout:
+                pass
+            stderr_reader.join()
+            stderr = "".join(stderr_chunks)
+
+        if proc.returncode != 0:
+            print(f"Ошибка при запуске context.py для {folder_path}: {stderr}")
             return 0, 0, 0, {}
 
-        # Парсим содержимое из stdout (отчет о токенах)
-        return parse_context_output(result.stdout)
+        return parsed
 
     except Exception as e:
         print(f"Произошла ошибка при обработке {folder_path}: {e}")
         return 0, 0, 0, {}
+    finally:
+        try:
+            os.unlink(output_file)
+        except OSError:
+            pass
+
+def fast_folder_report(folder_path: str, exclude_patterns: List[str]) -> Tuple[int, int, int, Dict[str, int]]:
+    """
+    Быстрая оценка папки без полного пайплайна context.py: текст файлов
+    прогоняется через приближенный режим estimate_gemini_tokens, базы
+    данных оцениваются по размеру файла. Шаблоны исключения файлов
+    применяются как в полном обходе; исключения таблиц (-et) здесь
+    неприменимы — базы не открываются. Порядок величины, не точный счет.
+    """
+    exclude_re = compile_exclude_patterns(exclude_patterns)
+    file_type_tokens = {}
+    db_tokens = 0
+    for entry in walk_files(folder_path, exclude_re):
+        if entry.name.endswith((".db", ".duckdb")):
+            try:
+                db_tokens += entry.stat().st_size // 4
+            except OSError:
+                pass
+            continue
+        # Бинарные файлы полный пайплайн не считает — здесь тоже пропускаем
+        if is_binary(entry.path):
+            continue
+        _, ext = os.path.splitext(entry.name)
+        # Те же имена типов, что в отчете context.py
+        file_type = ext if ext else "(без расширения)"
+        try:
+            with open(entry.path, 'r', encoding='utf-8', errors='ignore') as f:
+                tokens = estimate_gemini_tokens(f.read(), exact=False)
+        except OSError:
+            continue
+        file_type_tokens[file_type] = file_type_tokens.get(file_type, 0) + tokens
+
+    business_tokens = sum(file_type_tokens.values())
+    return business_tokens + db_tokens, business_tokens, db_tokens, file_type_tokens
 
-def parse_context_output(output: str) -> Tuple[int, int, int, Dict[str, int]]:
+def process_folder(entry_name: str, full_path: str, exclude_patterns: List[str], exclude_table_patterns: List[str],
+                   use_subprocess: bool = False, use_fast: bool = False,
+                   exact: bool = False) -> Tuple[str, Tuple[int, int, int], Dict[str, int]]:
+    """
+    Обрабатывает одну папку примера: по умолчанию считает токены
+    in-process через API context.py, без форка интерпретатора и разбора stdout.
+    Для папок сверх порога --fast-threshold используется грубая оценка.
+    Возвращает: (имя папки, (total, business, db), file_type_tokens)
+    """
+    if use_fast:
+        total_tokens, business_context_tokens, db_tokens, file_type_tokens = fast_folder_report(full_path, exclude_patterns)
+    elif use_subprocess:
+        total_tokens, business_context_tokens, db_tokens, file_type_tokens = run_context_py_and_parse_results(
+            full_path, exclude_patterns, exclude_table_patterns, exact=exact
+        )
+    else:
+        total_tokens, business_context_tokens, db_tokens, file_type_tokens = compute_token_report(
+            full_path, exclude_patterns, exclude_table_patterns, exact=exact
+        )
+    return entry_name, (total_tokens, business_context_tokens, db_tokens), file_type_tokens
+
+# Кеш результатов по папкам: повторные запуски пропускают неизменившиеся папки
+_CACHE_PATH = os.path.join("trv", ".token_cache.json")
+
+def folder_stats(folder_path: str) -> Tuple[float, int]:
+    """
+    Максимальный mtime и суммарный размер файлов по папке и всему ее
+    содержимому. Обход через os.scandir, stat берется из закешированных DirEntry.
+    """
+    total_size = 0
+    try:
+        max_mtime = os.stat(folder_path).st_mtime
+    except OSError:
+        return 0.0, 0
+    stack = [folder_path]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_mtime > max_mtime:
+                        max_mtime = st.st_mtime
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total_size += st.st_size
+        except OSError:
+            continue
+    return max_mtime, total_size
+
+def load_cache() -> Dict[str, dict]:
+    try:
+        with open(_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache: Dict[str, dict]):
+    try:
+        with open(_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"Не удалось сохранить кеш результатов: {e}")
+
+# Строка таблицы отчета: | категория | тип файла | токены |
+_ROW_RE = re.compile(r'^\|([^|]*)\|([^|]*)\|([^|]*)\|')
+
+# Мусорные символы в числе токенов (разделители разрядов, маркдаун-жирность)
+_TOK_TRANS = str.maketrans('', '', ',* ')
+
+# Итоговые категории таблицы -> ключ статистики
+_CAT_DISPATCH = {
+    '**ИТОГО**': 'total',
+    '**Весь бизнес-контекст**': 'business',
+    'Базы данных DuckDB': 'db',
+}
+
+def parse_context_output(output) -> Tuple[int, int, int, Dict[str, int]]:
     """
     Парсит вывод context.py и возвращает статистику по токенам.
+    Принимает строку целиком или итерируемый объект строк
+    (например, stdout работающего процесса).
     Возвращает: (total_tokens, business_context_tokens, db_tokens, file_type_tokens)
     """
-    total_tokens = 0
-    business_context_tokens = 0
-    db_tokens = 0
+    stats = {'total': 0, 'business': 0, 'db': 0}
     file_type_tokens = {}
 
     # Ищем таблицу с токенами в выводе
-    lines = output.split('\n')
+    if isinstance(output, str):
+        output = output.split('\n')
     in_table = False
 
-    for line in lines:
+    for line in output:
         line = line.strip()
-        if line.startswith('| Категория |'):
-            in_table = True
+        if not in_table:
+            if line.startswith('| Категория |'):
+                in_table = True
             continue
-        elif line.startswith('---') and in_table:
+        if line.startswith('---'):
             break
-        elif in_table and line.startswith('|'):
-            # Парсим строку таблицы
-            parts = [part.strip() for part in line.split('|')[1:-1]]  # Убираем пустые части от | в начале и конце
-            if len(parts) >= 3:
-                category, file_type, tokens_str = parts[0], parts[1], parts[2]
-
-                # Убираем запятые из числа токенов
-                try:
-                    tokens = int(tokens_str.replace(',', '').replace('**', ''))
-                except ValueError:
-                    continue
-
-                if category == '**ИТОГО**':
-                    total_tokens = tokens
-                elif category == '**Весь бизнес-контекст**':
-                    business_context_tokens = tokens
-                elif category == 'Бизнес-контекст':
-                    # Это тип файла
-                    file_type_tokens[file_type] = tokens
-                elif category == 'Базы данных DuckDB':
-                    db_tokens = tokens
-
-    return total_tokens, business_context_tokens, db_tokens, file_type_tokens
+
+        # Парсим строку таблицы одним заранее скомпилированным регексом
+        match = _ROW_RE.match(line)
+        if not match:
+            continue
+        category, file_type, tokens_str = (part.strip() for part in match.groups())
+
+        # Убираем запятые и прочий мусор из числа токенов одним проходом
+        try:
+            tokens = int(tokens_str.translate(_TOK_TRANS))
+        except ValueError:
+            continue
+
+        key = _CAT_DISPATCH.get(category)
+        if key:
+            stats[key] = tokens
+            # ИТОГО — всегда последняя строка таблицы, дальше можно не читать
+            if key == 'total':
+                break
+        elif category == 'Бизнес-контекст':
+            # Это тип файла
+            file_type_tokens[file_type] = tokens
+
+    return stats['total'], stats['business'], stats['db'], file_type_tokens
 
 def main():
+    parser = argparse.ArgumentParser(description="Считает токены по всем папкам примеров и пишет CSV-отчеты.")
+    parser.add_argument('--subprocess', action='store_true', dest='use_subprocess',
+                        help="Запускать context.py отдельным процессом на папку (старый путь с разбором stdout) вместо вызова API in-process.")
+    parser.add_argument('--fast-threshold', type=int, default=0, dest='fast_threshold',
+                        help="Папки с суммарным размером файлов больше указанного (в байтах) оценивать грубо, без полного пайплайна "
+                             "(0 — выключено). Исключения файлов учитываются, исключения таблиц в этом режиме не действуют.")
+    parser.add_argument('--exact-tokens', action='store_true', dest='exact_tokens',
+                        help="Считать токены настоящим токенизатором Gemma вместо быстрой оценки (1 токен ~ 4 символа). "
+                             "Папки сверх --fast-threshold все равно оцениваются грубо.")
+    args = parser.parse_args()
+
     examples_dir = "spider2-dbt/examples/"
     results = []
     file_type_results = {}
@@ -101,16 +260,51 @@ def main():
     # Собираем все уникальные типы файлов
     all_file_types = set()
 
-    for entry_name in tqdm(sorted(os.listdir(examples_dir))):
-        full_path = os.path.join(examples_dir, entry_name)
-        if os.path.isdir(full_path):
-            print(f"Обработка папки: {entry_name}")
+    # os.scandir отдает тип записи из одного readdir — без stat на каждую папку
+    folders = sorted(
+        ((entry.name, entry.path) for entry in os.scandir(examples_dir) if entry.is_dir()),
+        key=operator.itemgetter(0)
+    )
+
+    # Подпись запуска: изменение шаблонов или режима обесценивает кеш
+    cache = load_cache()
+    run_sig = repr((tuple(common_exclude_patterns), tuple(common_exclude_table_patterns),
+                    args.use_subprocess, args.fast_threshold, args.exact_tokens))
+
+    folder_mtimes = {}
+    to_process = []
+    for entry_name, full_path in folders:
+        mtime, folder_size = folder_stats(full_path)
+        folder_mtimes[entry_name] = mtime
+        cached = cache.get(entry_name)
+        if cached and cached.get("sig") == run_sig and cached.get("mtime") == mtime:
+            total_tokens, business_context_tokens, db_tokens, file_type_tokens = cached["result"]
+            results.append((entry_name, total_tokens, business_context_tokens, db_tokens))
+            file_type_results[entry_name] = file_type_tokens
+            all_file_types.update(file_type_tokens.keys())
+        else:
+            use_fast = bool(args.fast_threshold) and folder_size > args.fast_threshold
+            to_process.append((entry_name, full_path, use_fast))
+
+    if len(to_process) != len(folders):
+        print(f"Из кеша взято папок: {len(folders) - len(to_process)}")
+
+    # Папки независимы. In-process работа упирается в CPU — нужен пул
+    # процессов (обходим GIL); для подпроцессов context.py хватает потоков.
+    executor_cls = ThreadPoolExecutor if args.use_subprocess else ProcessPoolExecutor
+    with executor_cls(max_workers=os.cpu_count()) as executor:
+        futures = {
+            executor.submit(process_folder, entry_name, full_path,
+                            common_exclude_patterns, common_exclude_table_patterns,
+                            args.use_subprocess, use_fast, args.exact_tokens): entry_name
+            for entry_name, full_path, use_fast in to_process
+        }
 
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            entry_name = futures[future]
             try:
-                # Запускаем context.py и получаем результаты
-                total_tokens, business_context_tokens, db_tokens, file_type_tokens = run_context_py_and_parse_results(
-                    full_path, common_exclude_patterns, common_exclude_table_patterns
-                )
+                entry_name, totals, file_type_tokens = future.result()
+                total_tokens, business_context_tokens, db_tokens = totals
 
                 results.append((entry_name, total_tokens, business_context_tokens, db_tokens))
                 file_type_results[entry_name] = file_type_tokens
@@ -118,35 +312,46 @@ def main():
                 # Собираем все типы файлов
                 all_file_types.update(file_type_tokens.keys())
 
+                cache[entry_name] = {
+                    "sig": run_sig,
+                    "mtime": folder_mtimes[entry_name],
+                    "result": [total_tokens, business_context_tokens, db_tokens, file_type_tokens],
+                }
+
             except Exception as e:
                 print(f"Произошла непредвиденная ошибка для {entry_name}: {e}")
                 results.append((entry_name, "ОШИБКА", "ОШИБКА", "ОШИБКА"))
 
-    # Генерация первого CSV: папка - всего токенов - бизнес контекст - базы данных
-    with open("trv/tokens_summary.csv", 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(["Папка", "Всего токенов", "Бизнес контекст", "Базы данных"])
-        for folder, total_tokens, business_tokens, db_tokens in sorted(results, key=lambda x: x[0]):
-            if total_tokens == "ОШИБКА":
-                writer.writerow([folder, "ОШИБКА", "ОШИБКА", "ОШИБКА"])
-            else:
-                writer.writerow([folder, total_tokens, business_tokens, db_tokens])
-
-    # Генерация второго CSV: папка - всего токенов - колонки на каждый тип файла
-    with open("trv/tokens_by_filetype.csv", 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        header = ["Папка", "Всего токенов"] + sorted(all_file_types)
-        writer.writerow(header)
-
-        for folder, total_tokens, _, _ in sorted(results, key=lambda x: x[0]):
-            if total_tokens == "ОШИБКА":
-                row = [folder, "ОШИБКА"] + ["ОШИБКА"] * len(all_file_types)
-            else:
-                row = [folder, total_tokens]
-                for file_type in sorted(all_file_types):
-                    tokens = file_type_results[folder].get(file_type, 0)
-                    row.append(tokens)
-            writer.writerow(row)
+    save_cache(cache)
+
+    # Сортируем результаты один раз; itemgetter извлекает ключ на уровне C
+    results.sort(key=operator.itemgetter(0))
+
+    # Генерация обоих CSV за один проход по результатам:
+    # первый — папка - всего токенов - бизнес контекст - базы данных,
+    # второй — папка - всего токенов - колонки на каждый тип файла.
+    # Типы файлов сортируем один раз, а не на каждую строку
+    sorted_types = sorted(all_file_types)
+    summary_rows = []
+    filetype_rows = []
+    for folder, total_tokens, business_tokens, db_tokens in results:
+        if total_tokens == "ОШИБКА":
+            summary_rows.append([folder, "ОШИБКА", "ОШИБКА", "ОШИБКА"])
+            filetype_rows.append([folder, "ОШИБКА"] + ["ОШИБКА"] * len(sorted_types))
+        else:
+            summary_rows.append([folder, total_tokens, business_tokens, db_tokens])
+            ft_row = file_type_results[folder]
+            filetype_rows.append([folder, total_tokens] + [ft_row.get(file_type, 0) for file_type in sorted_types])
+
+    with open("trv/tokens_summary.csv", 'w', newline='', encoding='utf-8', buffering=1 << 20) as f_summary, \
+         open("trv/tokens_by_filetype.csv", 'w', newline='', encoding='utf-8', buffering=1 << 20) as f_filetype:
+        summary_writer = csv.writer(f_summary)
+        summary_writer.writerow(["Папка", "Всего токенов", "Бизнес контекст", "Базы данных"])
+        summary_writer.writerows(summary_rows)
+
+        filetype_writer = csv.writer(f_filetype)
+        filetype_writer.writerow(["Папка", "Всего токенов"] + sorted_types)
+        filetype_writer.writerows(filetype_rows)
 
     print("Отчеты сохранены в файлы: tokens_summary.csv и tokens_by_filetype.csv")
 